@@ -12,7 +12,22 @@ import json
 import time
 import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps_pretty(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps_pretty(obj):
+        return json.dumps(obj, indent=2, sort_keys=True).encode('utf-8')
 
 # Configuration
 GRAFANA_URL = "http://localhost:3000"
@@ -22,6 +37,8 @@ BASE_DIR = "/home/todd/ML-Lab/Olympus/ladon"
 PROVISIONED_DIR = f"{BASE_DIR}/grafana/provisioning/dashboards/json"
 CUSTOM_DIR = f"{BASE_DIR}/grafana/provisioning/dashboards/custom"
 LOG_FILE = f"{BASE_DIR}/logs/dashboard_fix.log"
+UID_CACHE_FILE = f"{BASE_DIR}/logs/provisioned_uids_cache.json"
+MAX_WORKERS = 8
 
 # Create directories
 Path(CUSTOM_DIR).mkdir(parents=True, exist_ok=True)
@@ -39,40 +56,103 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class _SafeFilenameTable(dict):
+    """str.translate table keeping alphanumerics, spaces, '-' and '_'; filled lazily per code point."""
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char in ' -_' else None
+        self[codepoint] = value
+        return value
+
+_SAFE_FILENAME_TABLE = _SafeFilenameTable()
+
+def create_session():
+    """Create a keep-alive session so all API calls reuse one pooled connection."""
+    session = requests.Session()
+    session.auth = (API_USER, API_PASSWORD)
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=16,
+        # Only retry idempotent reads; a re-sent DELETE would 404 and look like a failure
+        max_retries=Retry(total=3, backoff_factor=0.2, allowed_methods=frozenset({"GET", "HEAD"}))
+    )
+    session.mount("http://", adapter)
+    return session
+
 def wait_for_grafana():
-    """Wait for Grafana to be available."""
+    """Wait for Grafana to be available, polling with exponential backoff."""
     logger.info("Waiting for Grafana to be available...")
-    for i in range(30):
+    start = time.monotonic()
+    delay = 0.1
+    # A plain request (no urllib3 retries) so the backoff below sets the poll cadence
+    for i in range(40):
         try:
-            response = requests.get(f"{GRAFANA_URL}/api/health", timeout=5)
-            if response.status_code == 200:
+            response = requests.head(
+                f"{GRAFANA_URL}/api/health",
+                auth=(API_USER, API_PASSWORD),
+                timeout=2
+            )
+            if 200 <= response.status_code < 400:
                 logger.info("Grafana is available!")
                 return True
         except requests.RequestException:
             pass
-        time.sleep(2)
-    logger.error("Grafana not available after 60 seconds")
+        time.sleep(delay)
+        delay = min(delay * 1.7, 2.0)
+    logger.error(f"Grafana not available after {time.monotonic() - start:.0f} seconds")
     return False
 
+def load_uid_cache():
+    """Load the persisted {path: [st_mtime_ns, uid]} map from previous runs."""
+    try:
+        with open(UID_CACHE_FILE, 'rb') as f:
+            cache = _json_loads(f.read())
+        return cache if isinstance(cache, dict) else {}
+    except (ValueError, OSError):
+        return {}
+
+def save_uid_cache(cache):
+    """Persist the UID cache atomically; failures only cost a re-parse next run."""
+    temp_path = f"{UID_CACHE_FILE}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, UID_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Could not save UID cache {UID_CACHE_FILE}: {e}")
+
 def get_provisioned_uids():
     """Get UIDs of all provisioned dashboards."""
+    # Provisioned dashboard path -> [st_mtime_ns, uid], persisted between runs so
+    # unchanged files are not re-parsed
+    old_cache = load_uid_cache()
+    new_cache = {}
     provisioned_uids = set()
     for json_file in Path(PROVISIONED_DIR).glob("*.json"):
         try:
-            with open(json_file, 'r') as f:
-                data = json.load(f)
-                if 'uid' in data:
-                    provisioned_uids.add(data['uid'])
-        except (json.JSONDecodeError, OSError) as e:
+            mtime_ns = json_file.stat().st_mtime_ns
+            cached = old_cache.get(str(json_file))
+            if not isinstance(cached, list) or len(cached) != 2 or cached[0] != mtime_ns:
+                # Grafana writes "uid" as the last top-level key, so a streaming
+                # parser would still walk the whole file; one C-level parse is cheaper
+                with open(json_file, 'rb') as f:
+                    data = _json_loads(f.read())
+                cached = [mtime_ns, data.get('uid') if isinstance(data, dict) else None]
+            new_cache[str(json_file)] = cached
+            if cached[1]:
+                provisioned_uids.add(cached[1])
+        except (ValueError, OSError) as e:
             logger.warning(f"Could not read {json_file}: {e}")
+    
+    if new_cache != old_cache:
+        save_uid_cache(new_cache)
     return provisioned_uids
 
-def get_database_dashboards():
+def get_database_dashboards(session):
     """Get all dashboards from Grafana database."""
     try:
-        response = requests.get(
+        response = session.get(
             f"{GRAFANA_URL}/api/search?type=dash-db",
-            auth=(API_USER, API_PASSWORD),
             timeout=10
         )
         response.raise_for_status()
@@ -81,12 +161,11 @@ def get_database_dashboards():
         logger.error(f"Failed to get dashboards: {e}")
         return []
 
-def delete_dashboard(uid):
+def delete_dashboard(uid, session):
     """Delete a dashboard by UID."""
     try:
-        response = requests.delete(
+        response = session.delete(
             f"{GRAFANA_URL}/api/dashboards/uid/{uid}",
-            auth=(API_USER, API_PASSWORD),
             timeout=10
         )
         if response.status_code == 200:
@@ -99,12 +178,11 @@ def delete_dashboard(uid):
         logger.error(f"Error deleting dashboard {uid}: {e}")
         return False
 
-def backup_custom_dashboard(uid, title):
+def backup_custom_dashboard(uid, title, session):
     """Backup a custom dashboard to the custom directory."""
     try:
-        response = requests.get(
+        response = session.get(
             f"{GRAFANA_URL}/api/dashboards/uid/{uid}",
-            auth=(API_USER, API_PASSWORD),
             timeout=10
         )
         response.raise_for_status()
@@ -114,14 +192,21 @@ def backup_custom_dashboard(uid, title):
         dashboard = dashboard_data.get("dashboard", {})
         
         # Create a safe filename
-        safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        safe_title = title.translate(_SAFE_FILENAME_TABLE).rstrip()
         safe_title = safe_title.replace(' ', '-').lower()
         filename = f"{safe_title}.json"
         
-        # Save to custom directory
+        # Save to custom directory. Dashboards in different folders can share a title,
+        # and backups run concurrently, so write a per-UID temp file and replace
+        # atomically: the result is one complete dashboard, never interleaved bytes
         output_path = Path(CUSTOM_DIR) / filename
-        with open(output_path, 'w') as f:
-            json.dump(dashboard, f, indent=2)
+        temp_path = output_path.with_name(f".{filename}.{uid}.tmp")
+        try:
+            temp_path.write_bytes(_json_dumps_pretty(dashboard))
+            os.replace(temp_path, output_path)
+        except OSError:
+            temp_path.unlink(missing_ok=True)
+            raise
         
         logger.info(f"Backed up custom dashboard '{title}' to {output_path}")
         return True
@@ -133,33 +218,57 @@ def main():
     """Main function to fix dashboard persistence."""
     logger.info("Starting dashboard persistence fix...")
     
-    if not wait_for_grafana():
-        sys.exit(1)
-    
-    # Get provisioned UIDs
-    provisioned_uids = get_provisioned_uids()
-    logger.info(f"Found {len(provisioned_uids)} provisioned dashboard UIDs")
+    # One pooled connection for all Grafana API calls
+    session = create_session()
     
-    # Get database dashboards
-    db_dashboards = get_database_dashboards()
-    logger.info(f"Found {len(db_dashboards)} dashboards in database")
-    
-    # Process each dashboard
-    for dashboard in db_dashboards:
-        uid = dashboard.get('uid')
-        title = dashboard.get('title', 'Unknown')
+    try:
+        if not wait_for_grafana():
+            sys.exit(1)
         
-        if not uid:
-            continue
+        # Get provisioned UIDs
+        provisioned_uids = get_provisioned_uids()
+        logger.info(f"Found {len(provisioned_uids)} provisioned dashboard UIDs")
+        
+        # Get database dashboards
+        db_dashboards = get_database_dashboards(session)
+        logger.info(f"Found {len(db_dashboards)} dashboards in database")
+        
+        # Classify each dashboard
+        to_delete = []
+        to_backup = []
+        for dashboard in db_dashboards:
+            uid = dashboard.get('uid')
+            title = dashboard.get('title', 'Unknown')
+        
+            if not uid:
+                continue
             
-        if uid in provisioned_uids:
-            # This is a conflict - delete from database so provisioned version loads
-            logger.info(f"Removing conflicting dashboard '{title}' (UID: {uid}) from database")
-            delete_dashboard(uid)
-        else:
-            # This is a custom dashboard - back it up
-            logger.info(f"Backing up custom dashboard '{title}' (UID: {uid})")
-            backup_custom_dashboard(uid, title)
+            if uid in provisioned_uids:
+                # This is a conflict - delete from database so provisioned version loads
+                logger.info(f"Removing conflicting dashboard '{title}' (UID: {uid}) from database")
+                to_delete.append(uid)
+            else:
+                # This is a custom dashboard - back it up
+                logger.info(f"Backing up custom dashboard '{title}' (UID: {uid})")
+                to_backup.append((uid, title))
+        
+        # Dashboards are independent, so issue the API calls concurrently
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(delete_dashboard, uid, session): uid
+                for uid in to_delete
+            }
+            futures.update({
+                executor.submit(backup_custom_dashboard, uid, title, session): uid
+                for uid, title in to_backup
+            })
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Unexpected error processing dashboard {futures[future]}: {e}")
+    finally:
+        session.close()
     
     logger.info("Dashboard persistence fix complete!")
     logger.info("Restart Grafana to see the changes take effect")
@@ -6,10 +6,14 @@ Outputs to textfile for node_exporter collection
 """
 
 import subprocess
+import ctypes
+import fcntl
+import struct
 import json
 import re
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional
 
@@ -17,6 +21,54 @@ from typing import Dict, List, Optional
 METRICS_DIR = Path(os.getenv("METRICS_DIR", "/var/lib/node_exporter"))
 UPDATE_INTERVAL = int(os.getenv("NVME_UPDATE_INTERVAL", "30"))  # seconds
 NVME_DEVICES = ["nvme0", "nvme1", "nvme2", "nvme3"]  # Auto-detect if empty
+INFO_CACHE_TTL = int(os.getenv("NVME_INFO_CACHE_TTL", "3600"))  # seconds; re-identify after this
+FSYNC_METRICS = os.getenv("NVME_FSYNC", "1") != "0"  # Set to 0 when METRICS_DIR is tmpfs
+
+# NVMe admin passthrough (linux/nvme_ioctl.h: struct nvme_passthru_cmd)
+NVME_PASSTHRU_CMD = struct.Struct("<BBHIIIQQII6III")
+NVME_IOCTL_ADMIN_CMD = 0xC0484E41  # _IOWR('N', 0x41, struct nvme_admin_cmd)
+NVME_ADMIN_GET_LOG_PAGE = 0x02
+NVME_ADMIN_IDENTIFY = 0x06
+NVME_LOG_SMART = 0x02
+NVME_IDENTIFY_CTRL = 0x01
+NVME_NSID_ALL = 0xFFFFFFFF
+
+NVME_METRICS = [
+    # (metric name, type, help text, key in collected data)
+    ("nvme_temperature_celsius", "gauge", "Current temperature of NVMe device in Celsius", "temperature"),
+    ("nvme_available_spare_percent", "gauge", "Available spare capacity percentage", "available_spare"),
+    ("nvme_percentage_used", "gauge", "Percentage of rated endurance used", "percentage_used"),
+    ("nvme_critical_warning", "gauge", "Critical warning indicator (0=ok, >0=warning)", "critical_warning"),
+    ("nvme_data_units_read_total", "counter", "Total data units read (512-byte units)", "data_units_read"),
+    ("nvme_data_units_written_total", "counter", "Total data units written (512-byte units)", "data_units_written"),
+    ("nvme_host_read_commands_total", "counter", "Total host read commands", "host_read_commands"),
+    ("nvme_host_write_commands_total", "counter", "Total host write commands", "host_write_commands"),
+    ("nvme_power_on_hours_total", "counter", "Total power-on hours", "power_on_hours"),
+    ("nvme_power_cycles_total", "counter", "Total power cycles", "power_cycles"),
+    ("nvme_unsafe_shutdowns_total", "counter", "Total unsafe shutdowns", "unsafe_shutdowns"),
+    ("nvme_media_errors_total", "counter", "Total media errors", "media_errors"),
+    ("nvme_io_in_progress", "gauge", "Current I/O operations in progress", "io_in_progress"),
+]
+
+# HELP/TYPE lines are static, so join and encode them once at import:
+# (header block, metric name, key), all as UTF-8 bytes except the key
+_METRIC_HEADERS = [
+    (f"# HELP {name} {help_text}\n# TYPE {name} {metric_type}\n".encode(), name.encode(), key)
+    for name, metric_type, help_text, key in NVME_METRICS
+]
+
+# Model/serial/firmware never change while the device is attached: device -> (info, fetched_at).
+# The TTL makes a re-enumerated /dev/nvmeN pick up the new drive's identity.
+_info_cache: Dict[str, tuple] = {}
+
+# Encoded label sets keyed by (device, model, serial)
+_labels_cache: Dict[tuple, bytes] = {}
+
+# Prebuilt %-format templates keyed by device layout (device, labels, present keys)
+_template_cache: Dict[tuple, bytes] = {}
+
+# Hash of the last content written, used to skip rewriting an unchanged file
+_prev_hash: Optional[int] = None
 
 
 def run_command(cmd: List[str]) -> Optional[str]:
@@ -60,224 +112,208 @@ def detect_nvme_devices() -> List[str]:
         return []
 
 
+def nvme_admin_command(device: str, opcode: int, cdw10: int, data_len: int,
+                       nsid: int = 0) -> Optional[bytes]:
+    """Issue an NVMe admin command via ioctl and return the data buffer"""
+    buf = ctypes.create_string_buffer(data_len)
+    cmd = bytearray(NVME_PASSTHRU_CMD.pack(
+        opcode, 0, 0, nsid, 0, 0, 0, ctypes.addressof(buf), 0, data_len,
+        cdw10, 0, 0, 0, 0, 0, 0, 0
+    ))
+    try:
+        fd = os.open(f"/dev/{device}", os.O_RDONLY)
+        try:
+            # With a mutable buffer ioctl() returns the C result: a positive
+            # value is the NVMe completion status of a failed command
+            status = fcntl.ioctl(fd, NVME_IOCTL_ADMIN_CMD, cmd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Error issuing admin command 0x{opcode:02x} to {device}: {e}")
+        return None
+    if status != 0:
+        print(f"Error issuing admin command 0x{opcode:02x} to {device}: NVMe status 0x{status:x}")
+        return None
+    return buf.raw
+
+
+def _u128(data: bytes, offset: int) -> int:
+    """Decode a 16-byte little-endian SMART counter"""
+    return int.from_bytes(data[offset:offset + 16], "little")
+
+
 def get_nvme_smart(device: str) -> Optional[Dict]:
     """Get SMART data for NVMe device"""
-    output = run_command(["nvme", "smart-log", f"/dev/{device}", "-o", "json"])
-    if not output:
+    numdl = 512 // 4 - 1
+    data = nvme_admin_command(
+        device, NVME_ADMIN_GET_LOG_PAGE, NVME_LOG_SMART | (numdl << 16), 512,
+        nsid=NVME_NSID_ALL
+    )
+    if not data:
         return None
 
-    try:
-        return json.loads(output)
-    except json.JSONDecodeError:
-        print(f"Failed to parse SMART data for {device}")
-        return None
+    # Fixed SMART / Health Information log layout (NVMe base spec, log 02h)
+    return {
+        "critical_warning": data[0],
+        "temperature": struct.unpack_from("<H", data, 1)[0],  # Kelvin
+        "available_spare": data[3],
+        "percentage_used": data[5],
+        "data_units_read": _u128(data, 32),
+        "data_units_written": _u128(data, 48),
+        "host_read_commands": _u128(data, 64),
+        "host_write_commands": _u128(data, 80),
+        "power_cycles": _u128(data, 112),
+        "power_on_hours": _u128(data, 128),
+        "unsafe_shutdowns": _u128(data, 144),
+        "media_errors": _u128(data, 160),
+    }
 
 
 def get_nvme_info(device: str) -> Optional[Dict]:
     """Get device info (model, serial)"""
-    output = run_command(["nvme", "id-ctrl", f"/dev/{device}", "-o", "json"])
-    if not output:
+    data = nvme_admin_command(device, NVME_ADMIN_IDENTIFY, NVME_IDENTIFY_CTRL, 4096)
+    if not data:
         return None
 
-    try:
-        data = json.loads(output)
-        return {
-            "model": data.get("mn", "").strip(),
-            "serial": data.get("sn", "").strip(),
-            "firmware": data.get("fr", "").strip()
-        }
-    except json.JSONDecodeError:
-        print(f"Failed to parse device info for {device}")
-        return None
+    # Identify Controller: SN at bytes 4-23, MN at 24-63, FR at 64-71 (ASCII, space padded)
+    return {
+        "model": data[24:64].decode("ascii", "replace").strip(),
+        "serial": data[4:24].decode("ascii", "replace").strip(),
+        "firmware": data[64:72].decode("ascii", "replace").strip()
+    }
 
 
-def get_iostat(device: str) -> Optional[Dict]:
-    """Get current I/O statistics from /proc/diskstats"""
+def read_all_diskstats() -> Dict[str, List[str]]:
+    """Read /proc/diskstats once and index the fields by device name"""
+    stats = {}
     try:
         with open("/proc/diskstats", "r") as f:
             for line in f:
                 fields = line.split()
-                if len(fields) >= 14 and fields[2] == f"{device}n1":
-                    return {
-                        "reads_completed": int(fields[3]),
-                        "reads_merged": int(fields[4]),
-                        "sectors_read": int(fields[5]),
-                        "time_reading_ms": int(fields[6]),
-                        "writes_completed": int(fields[7]),
-                        "writes_merged": int(fields[8]),
-                        "sectors_written": int(fields[9]),
-                        "time_writing_ms": int(fields[10]),
-                        "io_in_progress": int(fields[11]),
-                        "time_io_ms": int(fields[12]),
-                        "weighted_time_io_ms": int(fields[13])
-                    }
-    except Exception as e:
-        print(f"Failed to read iostat for {device}: {e}")
-    return None
-
-
-def format_prometheus_metrics(metrics: Dict[str, List[Dict]]) -> str:
-    """Format metrics in Prometheus text format"""
-    lines = []
-    timestamp = int(time.time() * 1000)
-
-    # Temperature metrics
-    lines.append("# HELP nvme_temperature_celsius Current temperature of NVMe device in Celsius")
-    lines.append("# TYPE nvme_temperature_celsius gauge")
-    for device, data in metrics.items():
-        if data and "temperature" in data[0]:
-            temp = data[0]["temperature"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_temperature_celsius{{device="{device}",model="{model}",serial="{serial}"}} {temp}'
-            )
-
-    # Available spare percentage
-    lines.append("# HELP nvme_available_spare_percent Available spare capacity percentage")
-    lines.append("# TYPE nvme_available_spare_percent gauge")
-    for device, data in metrics.items():
-        if data and "available_spare" in data[0]:
-            spare = data[0]["available_spare"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_available_spare_percent{{device="{device}",model="{model}",serial="{serial}"}} {spare}'
-            )
+                if len(fields) >= 14:
+                    stats[fields[2]] = fields
+    except OSError as e:
+        print(f"Failed to read /proc/diskstats: {e}")
+    return stats
 
-    # Percentage used
-    lines.append("# HELP nvme_percentage_used Percentage of rated endurance used")
-    lines.append("# TYPE nvme_percentage_used gauge")
-    for device, data in metrics.items():
-        if data and "percentage_used" in data[0]:
-            used = data[0]["percentage_used"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_percentage_used{{device="{device}",model="{model}",serial="{serial}"}} {used}'
-            )
 
-    # Critical warning
-    lines.append("# HELP nvme_critical_warning Critical warning indicator (0=ok, >0=warning)")
-    lines.append("# TYPE nvme_critical_warning gauge")
-    for device, data in metrics.items():
-        if data and "critical_warning" in data[0]:
-            warning = data[0]["critical_warning"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_critical_warning{{device="{device}",model="{model}",serial="{serial}"}} {warning}'
-            )
-
-    # Data units read (512-byte units)
-    lines.append("# HELP nvme_data_units_read_total Total data units read (512-byte units)")
-    lines.append("# TYPE nvme_data_units_read_total counter")
-    for device, data in metrics.items():
-        if data and "data_units_read" in data[0]:
-            units = data[0]["data_units_read"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_data_units_read_total{{device="{device}",model="{model}",serial="{serial}"}} {units}'
-            )
-
-    # Data units written (512-byte units)
-    lines.append("# HELP nvme_data_units_written_total Total data units written (512-byte units)")
-    lines.append("# TYPE nvme_data_units_written_total counter")
-    for device, data in metrics.items():
-        if data and "data_units_written" in data[0]:
-            units = data[0]["data_units_written"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_data_units_written_total{{device="{device}",model="{model}",serial="{serial}"}} {units}'
-            )
+def get_iostat(device: str, stats: Dict[str, List[str]]) -> Optional[Dict]:
+    """Get current I/O statistics from pre-read /proc/diskstats fields"""
+    fields = stats.get(f"{device}n1")
+    if not fields:
+        return None
 
-    # Host read commands
-    lines.append("# HELP nvme_host_read_commands_total Total host read commands")
-    lines.append("# TYPE nvme_host_read_commands_total counter")
-    for device, data in metrics.items():
-        if data and "host_read_commands" in data[0]:
-            cmds = data[0]["host_read_commands"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_host_read_commands_total{{device="{device}",model="{model}",serial="{serial}"}} {cmds}'
-            )
+    try:
+        return {
+            "reads_completed": int(fields[3]),
+            "reads_merged": int(fields[4]),
+            "sectors_read": int(fields[5]),
+            "time_reading_ms": int(fields[6]),
+            "writes_completed": int(fields[7]),
+            "writes_merged": int(fields[8]),
+            "sectors_written": int(fields[9]),
+            "time_writing_ms": int(fields[10]),
+            "io_in_progress": int(fields[11]),
+            "time_io_ms": int(fields[12]),
+            "weighted_time_io_ms": int(fields[13])
+        }
+    except ValueError as e:
+        print(f"Failed to parse iostat for {device}: {e}")
+        return None
 
-    # Host write commands
-    lines.append("# HELP nvme_host_write_commands_total Total host write commands")
-    lines.append("# TYPE nvme_host_write_commands_total counter")
-    for device, data in metrics.items():
-        if data and "host_write_commands" in data[0]:
-            cmds = data[0]["host_write_commands"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_host_write_commands_total{{device="{device}",model="{model}",serial="{serial}"}} {cmds}'
-            )
 
-    # Power on hours
-    lines.append("# HELP nvme_power_on_hours_total Total power-on hours")
-    lines.append("# TYPE nvme_power_on_hours_total counter")
-    for device, data in metrics.items():
-        if data and "power_on_hours" in data[0]:
-            hours = data[0]["power_on_hours"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_power_on_hours_total{{device="{device}",model="{model}",serial="{serial}"}} {hours}'
-            )
+def build_metrics_template(layout: tuple) -> bytes:
+    """Build a %-format template with one %d slot per sample for a device layout"""
+    buf = bytearray()
+    for header, name, key in _METRIC_HEADERS:
+        buf += header.replace(b"%", b"%%")
+        for device, label_bytes, present in layout:
+            if key in present:
+                buf += b"%s{%s} %%d\n" % (name, label_bytes.replace(b"%", b"%%"))
+    return bytes(buf)
 
-    # Power cycles
-    lines.append("# HELP nvme_power_cycles_total Total power cycles")
-    lines.append("# TYPE nvme_power_cycles_total counter")
-    for device, data in metrics.items():
-        if data and "power_cycles" in data[0]:
-            cycles = data[0]["power_cycles"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_power_cycles_total{{device="{device}",model="{model}",serial="{serial}"}} {cycles}'
-            )
 
-    # Unsafe shutdowns
-    lines.append("# HELP nvme_unsafe_shutdowns_total Total unsafe shutdowns")
-    lines.append("# TYPE nvme_unsafe_shutdowns_total counter")
+def format_prometheus_metrics(metrics: Dict[str, List[Dict]]) -> bytes:
+    """Format metrics in Prometheus text format, encoded as UTF-8"""
+    # Label sets are identical for every metric of a device, so encode them once
+    layout = []
     for device, data in metrics.items():
-        if data and "unsafe_shutdowns" in data[0]:
-            shutdowns = data[0]["unsafe_shutdowns"]
+        if data:
             model = data[0].get("model", "unknown")
             serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_unsafe_shutdowns_total{{device="{device}",model="{model}",serial="{serial}"}} {shutdowns}'
-            )
-
-    # Media errors
-    lines.append("# HELP nvme_media_errors_total Total media errors")
-    lines.append("# TYPE nvme_media_errors_total counter")
-    for device, data in metrics.items():
-        if data and "media_errors" in data[0]:
-            errors = data[0]["media_errors"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_media_errors_total{{device="{device}",model="{model}",serial="{serial}"}} {errors}'
-            )
-
-    # I/O in progress
-    lines.append("# HELP nvme_io_in_progress Current I/O operations in progress")
-    lines.append("# TYPE nvme_io_in_progress gauge")
-    for device, data in metrics.items():
-        if data and "io_in_progress" in data[0]:
-            io_prog = data[0]["io_in_progress"]
-            model = data[0].get("model", "unknown")
-            serial = data[0].get("serial", "unknown")
-            lines.append(
-                f'nvme_io_in_progress{{device="{device}",model="{model}",serial="{serial}"}} {io_prog}'
-            )
+            label_key = (device, model, serial)
+            if label_key not in _labels_cache:
+                _labels_cache[label_key] = f'device="{device}",model="{model}",serial="{serial}"'.encode()
+            layout.append((device, _labels_cache[label_key], frozenset(data[0])))
+    layout = tuple(layout)
+
+    # The text layout only changes when devices or their available fields do,
+    # so each tick just substitutes values into a cached template
+    template = _template_cache.get(layout)
+    if template is None:
+        template = _template_cache[layout] = build_metrics_template(layout)
+
+    values = tuple(
+        metrics[device][0][key]
+        for header, name, key in _METRIC_HEADERS
+        for device, label_bytes, present in layout
+        if key in present
+    )
+    return template % values
+
+
+def poll_device(device: str, diskstats: Dict[str, List[str]]) -> Optional[Dict]:
+    """Collect combined info, SMART and I/O data for a single device"""
+    print(f"Collecting metrics for {device}")
+
+    # Get device info (identify data is cached after a successful Identify)
+    now = time.monotonic()
+    cached = _info_cache.get(device)
+    if cached and now - cached[1] < INFO_CACHE_TTL:
+        info = cached[0]
+    else:
+        info = get_nvme_info(device)
+        if not info:
+            _info_cache.pop(device, None)
+            return None
+        if info["serial"]:
+            _info_cache[device] = (info, now)
+
+    # Get SMART data
+    smart = get_nvme_smart(device)
+    if not smart:
+        return None
 
-    return "\n".join(lines) + "\n"
+    # Get I/O stats
+    iostat = get_iostat(device, diskstats)
+
+    # Combine all data
+    # Note: temperature is in Kelvin, convert to Celsius
+    temp_kelvin = smart.get("temperature", 0)
+    temp_celsius = temp_kelvin - 273 if temp_kelvin > 0 else 0
+
+    combined = {
+        "model": info["model"],
+        "serial": info["serial"],
+        "firmware": info["firmware"],
+        "temperature": temp_celsius,
+        "critical_warning": smart.get("critical_warning", 0),
+        "available_spare": smart.get("available_spare", 0),
+        "percentage_used": smart.get("percentage_used", 0),
+        "data_units_read": smart.get("data_units_read", 0),
+        "data_units_written": smart.get("data_units_written", 0),
+        "host_read_commands": smart.get("host_read_commands", 0),
+        "host_write_commands": smart.get("host_write_commands", 0),
+        "power_on_hours": smart.get("power_on_hours", 0),
+        "power_cycles": smart.get("power_cycles", 0),
+        "unsafe_shutdowns": smart.get("unsafe_shutdowns", 0),
+        "media_errors": smart.get("media_errors", 0),
+    }
+
+    if iostat:
+        combined.update(iostat)
+
+    return combined
 
 
 def collect_metrics() -> Dict[str, List[Dict]]:
@@ -287,64 +323,41 @@ def collect_metrics() -> Dict[str, List[Dict]]:
         print("No NVMe devices found")
         return {}
 
-    metrics = {}
-    for device in devices:
-        print(f"Collecting metrics for {device}")
+    diskstats = read_all_diskstats()
 
-        # Get device info
-        info = get_nvme_info(device)
-        if not info:
-            continue
-
-        # Get SMART data
-        smart = get_nvme_smart(device)
-        if not smart:
-            continue
-
-        # Get I/O stats
-        iostat = get_iostat(device)
-
-        # Combine all data
-        # Note: temperature is in Kelvin, convert to Celsius
-        temp_kelvin = smart.get("temperature", 0)
-        temp_celsius = temp_kelvin - 273 if temp_kelvin > 0 else 0
-
-        combined = {
-            "model": info["model"],
-            "serial": info["serial"],
-            "firmware": info["firmware"],
-            "temperature": temp_celsius,
-            "critical_warning": smart.get("critical_warning", 0),
-            "available_spare": smart.get("available_spare", 0),
-            "percentage_used": smart.get("percentage_used", 0),
-            "data_units_read": smart.get("data_units_read", 0),
-            "data_units_written": smart.get("data_units_written", 0),
-            "host_read_commands": smart.get("host_read_commands", 0),
-            "host_write_commands": smart.get("host_write_commands", 0),
-            "power_on_hours": smart.get("power_on_hours", 0),
-            "power_cycles": smart.get("power_cycles", 0),
-            "unsafe_shutdowns": smart.get("unsafe_shutdowns", 0),
-            "media_errors": smart.get("media_errors", 0),
-        }
-
-        if iostat:
-            combined.update(iostat)
+    # Admin ioctls block in the driver, so poll every device in parallel
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        results = list(executor.map(lambda d: poll_device(d, diskstats), devices))
 
-        metrics[device] = [combined]
+    metrics = {}
+    for device, combined in zip(devices, results):
+        if combined:
+            metrics[device] = [combined]
 
     return metrics
 
 
 def write_metrics(metrics: Dict[str, List[Dict]], output_file: Path):
-    """Write metrics to file atomically"""
+    """Write metrics to file atomically, skipping the write if nothing changed"""
+    global _prev_hash
+
     output_file.parent.mkdir(parents=True, exist_ok=True)
 
     content = format_prometheus_metrics(metrics)
+    content_hash = hash(content)
+    if content_hash == _prev_hash and output_file.exists():
+        print(f"Metrics unchanged, skipping write to {output_file}")
+        return
 
-    # Write atomically
+    # Write atomically; fsync before replace so a crash never exposes a partial file
     temp_file = output_file.with_suffix(".tmp")
-    temp_file.write_text(content)
-    temp_file.rename(output_file)
+    with open(temp_file, "wb") as f:
+        f.write(content)
+        f.flush()
+        if FSYNC_METRICS:
+            os.fsync(f.fileno())
+    os.replace(temp_file, output_file)
+    _prev_hash = content_hash
 
     print(f"Metrics written to {output_file}")
 
@@ -369,7 +382,9 @@ def main():
             import traceback
             traceback.print_exc()
 
-        time.sleep(UPDATE_INTERVAL)
+        # Sleep until the next interval boundary so slow ticks don't drift the cadence
+        next_tick = (int(time.time()) // UPDATE_INTERVAL + 1) * UPDATE_INTERVAL
+        time.sleep(max(0, next_tick - time.time()))
 
 
 if __name__ == "__main__":
@@ -2,26 +2,44 @@
 """
 Simple GPU metrics exporter for Prometheus.
 
-This script runs nvidia-smi and exposes basic GPU metrics in Prometheus format.
+This script queries NVML (via pynvml) and exposes basic GPU metrics in Prometheus format.
 Much simpler than DCGM and doesn't require NVIDIA Container Toolkit.
 """
 
-import subprocess
 import time
-import re
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import json
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pynvml
+from prometheus_client import CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+# NVML device handles and static per-GPU (name, power limit), populated once by init_nvml()
+GPU_HANDLES = []
+GPU_STATIC = {}
+
+# Scrapes within CACHE_TTL seconds share one NVML poll; 'entry' is (body, etag)
+CACHE_TTL = 1.0
+_cache = {'ts': 0.0, 'entry': (b'', '')}
+_cache_lock = threading.Lock()
 
 
 class GPUMetricsHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         if self.path == '/metrics':
             try:
-                metrics = get_gpu_metrics()
+                metrics, etag = get_cached_gpu_metrics()
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
                 self.send_response(200)
-                self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-type', CONTENT_TYPE_LATEST)
+                self.send_header('ETag', etag)
                 self.end_headers()
-                self.wfile.write(metrics.encode())
+                self.wfile.write(metrics)
             except Exception as e:
                 self.send_response(500)
                 self.send_header('Content-type', 'text/plain')
@@ -36,118 +54,118 @@ class GPUMetricsHandler(BaseHTTPRequestHandler):
         pass
 
 
-def get_gpu_metrics():
-    """Get GPU metrics from nvidia-smi and format for Prometheus."""
+def init_nvml():
+    """Initialize NVML once and cache a handle for every GPU."""
+    pynvml.nvmlInit()
+    GPU_HANDLES[:] = [
+        pynvml.nvmlDeviceGetHandleByIndex(i)
+        for i in range(pynvml.nvmlDeviceGetCount())
+    ]
+    
+    # Name and power limit don't change between scrapes, so query them only here
+    GPU_STATIC.clear()
+    for gpu_index, handle in enumerate(GPU_HANDLES):
+        name = pynvml.nvmlDeviceGetName(handle)
+        if isinstance(name, bytes):
+            name = name.decode()
+        power_limit = nvml_query(pynvml.nvmlDeviceGetPowerManagementLimit, handle) / 1000.0  # mW to W
+        GPU_STATIC[gpu_index] = (name.replace(' ', '_'), power_limit)
+
+
+def nvml_query(func, *args):
+    """Call an NVML query, returning 0 for fields the GPU does not support."""
     try:
-        # Run nvidia-smi with JSON output
-        cmd = [
-            'nvidia-smi', 
-            '--query-gpu=index,name,temperature.gpu,utilization.gpu,utilization.memory,memory.total,memory.used,memory.free,power.draw,power.limit',
-            '--format=csv,noheader,nounits'
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-        
-        if result.returncode != 0:
-            raise Exception(f"nvidia-smi failed: {result.stderr}")
-        
-        lines = result.stdout.strip().split('\n')
-        metrics = []
-        
-        # Add metric headers
-        metrics.append("# HELP nvidia_gpu_temperature_celsius GPU temperature in Celsius")
-        metrics.append("# TYPE nvidia_gpu_temperature_celsius gauge")
-        
-        metrics.append("# HELP nvidia_gpu_utilization_percent GPU utilization percentage")
-        metrics.append("# TYPE nvidia_gpu_utilization_percent gauge")
-        
-        metrics.append("# HELP nvidia_gpu_memory_utilization_percent GPU memory utilization percentage")
-        metrics.append("# TYPE nvidia_gpu_memory_utilization_percent gauge")
-        
-        metrics.append("# HELP nvidia_gpu_memory_total_bytes GPU total memory in bytes")
-        metrics.append("# TYPE nvidia_gpu_memory_total_bytes gauge")
-        
-        metrics.append("# HELP nvidia_gpu_memory_used_bytes GPU used memory in bytes")
-        metrics.append("# TYPE nvidia_gpu_memory_used_bytes gauge")
-        
-        metrics.append("# HELP nvidia_gpu_memory_free_bytes GPU free memory in bytes")
-        metrics.append("# TYPE nvidia_gpu_memory_free_bytes gauge")
-        
-        metrics.append("# HELP nvidia_gpu_power_draw_watts GPU power draw in watts")
-        metrics.append("# TYPE nvidia_gpu_power_draw_watts gauge")
-        
-        metrics.append("# HELP nvidia_gpu_power_limit_watts GPU power limit in watts")
-        metrics.append("# TYPE nvidia_gpu_power_limit_watts gauge")
+        return func(*args)
+    except pynvml.NVMLError_NotSupported:
+        return 0
+
+
+class GPUCollector:
+    """Prometheus collector that reads every GPU from NVML on each collection."""
+    
+    def collect(self):
+        labels = ['gpu', 'name']
+        temperature = GaugeMetricFamily('nvidia_gpu_temperature_celsius', 'GPU temperature in Celsius', labels=labels)
+        util_gpu = GaugeMetricFamily('nvidia_gpu_utilization_percent', 'GPU utilization percentage', labels=labels)
+        util_mem = GaugeMetricFamily('nvidia_gpu_memory_utilization_percent', 'GPU memory utilization percentage', labels=labels)
+        mem_total = GaugeMetricFamily('nvidia_gpu_memory_total_bytes', 'GPU total memory in bytes', labels=labels)
+        mem_used = GaugeMetricFamily('nvidia_gpu_memory_used_bytes', 'GPU used memory in bytes', labels=labels)
+        mem_free = GaugeMetricFamily('nvidia_gpu_memory_free_bytes', 'GPU free memory in bytes', labels=labels)
+        power_draw = GaugeMetricFamily('nvidia_gpu_power_draw_watts', 'GPU power draw in watts', labels=labels)
+        power_limit = GaugeMetricFamily('nvidia_gpu_power_limit_watts', 'GPU power limit in watts', labels=labels)
         
         # Process each GPU
-        for line in lines:
-            if not line.strip():
-                continue
-                
-            parts = [p.strip() for p in line.split(',')]
-            if len(parts) < 10:
-                continue
-                
-            try:
-                gpu_index = parts[0]
-                gpu_name = parts[1].replace(' ', '_')
-                temp = float(parts[2]) if parts[2] != '[Not Supported]' else 0
-                util_gpu = float(parts[3]) if parts[3] != '[Not Supported]' else 0
-                util_mem = float(parts[4]) if parts[4] != '[Not Supported]' else 0
-                mem_total = float(parts[5]) * 1024 * 1024 if parts[5] != '[Not Supported]' else 0  # MB to bytes
-                mem_used = float(parts[6]) * 1024 * 1024 if parts[6] != '[Not Supported]' else 0   # MB to bytes
-                mem_free = float(parts[7]) * 1024 * 1024 if parts[7] != '[Not Supported]' else 0   # MB to bytes
-                power_draw = float(parts[8]) if parts[8] != '[Not Supported]' else 0
-                power_limit = float(parts[9]) if parts[9] != '[Not Supported]' else 0
-                
-                # Add metrics for this GPU
-                labels = f'gpu="{gpu_index}",name="{gpu_name}"'
-                
-                metrics.append(f'nvidia_gpu_temperature_celsius{{{labels}}} {temp}')
-                metrics.append(f'nvidia_gpu_utilization_percent{{{labels}}} {util_gpu}')
-                metrics.append(f'nvidia_gpu_memory_utilization_percent{{{labels}}} {util_mem}')
-                metrics.append(f'nvidia_gpu_memory_total_bytes{{{labels}}} {int(mem_total)}')
-                metrics.append(f'nvidia_gpu_memory_used_bytes{{{labels}}} {int(mem_used)}')
-                metrics.append(f'nvidia_gpu_memory_free_bytes{{{labels}}} {int(mem_free)}')
-                metrics.append(f'nvidia_gpu_power_draw_watts{{{labels}}} {power_draw}')
-                metrics.append(f'nvidia_gpu_power_limit_watts{{{labels}}} {power_limit}')
-                
-            except (ValueError, IndexError) as e:
-                print(f"Error parsing GPU data: {e}")
-                continue
+        for gpu_index, handle in enumerate(GPU_HANDLES):
+            gpu_name, limit = GPU_STATIC[gpu_index]
+            label_values = [str(gpu_index), gpu_name]
+            
+            utilization = nvml_query(pynvml.nvmlDeviceGetUtilizationRates, handle)
+            memory = nvml_query(pynvml.nvmlDeviceGetMemoryInfo, handle)
+            
+            temperature.add_metric(label_values, nvml_query(pynvml.nvmlDeviceGetTemperature, handle, pynvml.NVML_TEMPERATURE_GPU))
+            util_gpu.add_metric(label_values, utilization.gpu if utilization else 0)
+            util_mem.add_metric(label_values, utilization.memory if utilization else 0)
+            mem_total.add_metric(label_values, memory.total if memory else 0)
+            mem_used.add_metric(label_values, memory.used if memory else 0)
+            mem_free.add_metric(label_values, memory.free if memory else 0)
+            power_draw.add_metric(label_values, nvml_query(pynvml.nvmlDeviceGetPowerUsage, handle) / 1000.0)  # mW to W
+            power_limit.add_metric(label_values, limit)
+        
+        yield from (temperature, util_gpu, util_mem, mem_total, mem_used, mem_free, power_draw, power_limit)
         
         # Add a simple up metric
-        metrics.append("# HELP nvidia_gpu_exporter_up Whether the exporter is working")
-        metrics.append("# TYPE nvidia_gpu_exporter_up gauge")
-        metrics.append("nvidia_gpu_exporter_up 1")
-        
-        return '\n'.join(metrics) + '\n'
-        
-    except subprocess.TimeoutExpired:
-        raise Exception("nvidia-smi timeout")
-    except FileNotFoundError:
-        raise Exception("nvidia-smi not found")
+        yield GaugeMetricFamily('nvidia_gpu_exporter_up', 'Whether the exporter is working', value=1)
+
+
+# Dedicated registry so only GPU metrics are exposed (no process/platform collectors)
+REGISTRY = CollectorRegistry()
+REGISTRY.register(GPUCollector())
+
+
+def get_gpu_metrics():
+    """Get GPU metrics from NVML rendered in Prometheus text format."""
+    try:
+        return generate_latest(REGISTRY)
+    except pynvml.NVMLError as e:
+        raise Exception(f"NVML query failed: {str(e)}")
     except Exception as e:
         raise Exception(f"Failed to get GPU metrics: {str(e)}")
 
 
+def get_cached_gpu_metrics():
+    """Return recent (metrics, etag), letting concurrent scrapes coalesce on one poll."""
+    if time.monotonic() - _cache['ts'] < CACHE_TTL:
+        return _cache['entry']
+    with _cache_lock:
+        # Another thread may have refreshed the cache while we waited
+        if time.monotonic() - _cache['ts'] < CACHE_TTL:
+            return _cache['entry']
+        body = get_gpu_metrics()
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        _cache['entry'] = (body, etag)
+        _cache['ts'] = time.monotonic()
+        return _cache['entry']
+
+
 def main():
     """Run the GPU metrics HTTP server."""
     server_address = ('', 9445)
-    httpd = HTTPServer(server_address, GPUMetricsHandler)
+    httpd = ThreadingHTTPServer(server_address, GPUMetricsHandler)
     
     print("Starting GPU metrics exporter on port 9445...")
     print("Metrics available at http://localhost:9445/metrics")
     
     try:
-        # Test nvidia-smi first
+        # Initialize NVML once and test it before serving
+        init_nvml()
         test_metrics = get_gpu_metrics()
-        print("✓ nvidia-smi working, found metrics")
+        print(f"✓ NVML working, found {len(GPU_HANDLES)} GPU(s)")
         
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down...")
         httpd.shutdown()
+        pynvml.nvmlShutdown()
     except Exception as e:
         print(f"Error: {e}")
         exit(1)
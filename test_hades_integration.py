@@ -5,60 +5,205 @@ Test script for HADES-ladon monitoring integration.
 This script tests the connectivity and configuration between HADES and ladon monitoring stack.
 """
 
+import functools
+import os
+import re
+import socket
+import sys
 import requests
 import yaml
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, ALL_COMPLETED
 from pathlib import Path
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Use the libyaml C loader when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Matches HADES job names case-insensitively in both the config and the targets API
+HADES_RE = re.compile(r'hades', re.IGNORECASE)
+
+# Shared keep-alive session so repeated probes reuse pooled connections
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+
+
+def load_cached_yaml(path):
+    """Load a YAML file, reusing a JSON sidecar cache while the YAML is unchanged."""
+    path = Path(path)
+    cache_path = path.with_name(f".{path.name}.cache.json")
+    
+    # The sidecar records the YAML's exact mtime and size; any difference (including
+    # an older mtime from cp -p or a restore) invalidates it
+    stat = os.stat(path)
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('mtime_ns') == stat.st_mtime_ns and cached.get('size') == stat.st_size:
+            return cached['data']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    
+    # Binary mode lets the C loader consume bytes without a text decode layer
+    with open(path, 'rb') as f:
+        data = yaml.load(f, Loader=YAML_LOADER)
+    
+    # Refresh the sidecar atomically; caching is best-effort
+    tmp_path = cache_path.with_suffix(".tmp")
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'data': data}, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError):
+        tmp_path.unlink(missing_ok=True)
+    
+    return data
 
 def test_prometheus_config():
     """Test the Prometheus configuration for HADES integration."""
-    print("="*60)
-    print("Testing Prometheus Configuration")
-    print("="*60)
+    log = ["="*60, "Testing Prometheus Configuration", "="*60]
     
     try:
         # Read prometheus.yml
         prometheus_config_path = Path("prometheus/prometheus.yml")
-        if not prometheus_config_path.exists():
-            print("❌ prometheus.yml not found")
-            return False
-        
-        with open(prometheus_config_path, 'r') as f:
-            config = yaml.safe_load(f)
+        try:
+            config = load_cached_yaml(prometheus_config_path)
+        except FileNotFoundError:
+            log.append("❌ prometheus.yml not found")
+            return False, log
         
         # Check for HADES job
         scrape_configs = config.get('scrape_configs', [])
-        hades_jobs = [job for job in scrape_configs if 'hades' in job.get('job_name', '')]
+        hades_jobs = tuple(job for job in scrape_configs if HADES_RE.search(job.get('job_name') or ''))
         
         if not hades_jobs:
-            print("❌ No HADES jobs found in Prometheus configuration")
-            return False
+            log.append("❌ No HADES jobs found in Prometheus configuration")
+            return False, log
         
-        print(f"✓ Found {len(hades_jobs)} HADES job(s) in Prometheus config:")
+        log.append(f"✓ Found {len(hades_jobs)} HADES job(s) in Prometheus config:")
         for job in hades_jobs:
             job_name = job.get('job_name')
             targets = job.get('static_configs', [{}])[0].get('targets', [])
             metrics_path = job.get('metrics_path', '/metrics')
             scrape_interval = job.get('scrape_interval', 'default')
             
-            print(f"  - Job: {job_name}")
-            print(f"    Targets: {targets}")
-            print(f"    Metrics path: {metrics_path}")
-            print(f"    Scrape interval: {scrape_interval}")
+            log.append(f"  - Job: {job_name}")
+            log.append(f"    Targets: {targets}")
+            log.append(f"    Metrics path: {metrics_path}")
+            log.append(f"    Scrape interval: {scrape_interval}")
         
-        return True
+        return True, log
         
     except Exception as e:
-        print(f"❌ Error reading Prometheus config: {e}")
+        log.append(f"❌ Error reading Prometheus config: {e}")
+        return False, log
+
+
+@functools.lru_cache(maxsize=16)
+def resolvable(host):
+    """Check (once per host) whether a hostname resolves, outside any HTTP timeout."""
+    try:
+        socket.getaddrinfo(host, None)
+        return True
+    except socket.gaierror:
         return False
 
 
+def failure_message(endpoint, error):
+    """Describe a failed request to an endpoint."""
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return f"❌ FAILED: {endpoint} - Connection refused"
+    if isinstance(error, requests.exceptions.Timeout):
+        return f"❌ FAILED: {endpoint} - Timeout"
+    return f"❌ FAILED: {endpoint} - Error: {error}"
+
+
+def probe_endpoint(endpoint):
+    """Check liveness of a HADES metrics endpoint with a cheap HEAD request.
+    
+    Returns (alive, report lines).
+    """
+    report = [f"\nTesting {endpoint}..."]
+    alive = False
+    
+    # Resolve on this worker thread so a slow DNS lookup doesn't hold up other probes
+    if not resolvable(urlparse(endpoint).hostname):
+        report.append(f"❌ FAILED: {endpoint} - Hostname does not resolve")
+        return alive, report
+    
+    try:
+        # HEAD skips the metrics body; a short connect timeout fails dead hosts fast.
+        # 405 still proves the server is up if it only routes GET.
+        response = SESSION.head(endpoint, timeout=(1, 2), allow_redirects=False)
+        if response.status_code in (200, 405):
+            report.append(f"✓ Reachable: {endpoint}")
+            alive = True
+        else:
+            report.append(f"❌ FAILED: {endpoint} - Status {response.status_code}")
+    except Exception as e:
+        report.append(failure_message(endpoint, e))
+    
+    return alive, report
+
+
+def fetch_endpoint_metrics(endpoint):
+    """Fetch metrics from a live endpoint and summarize its content.
+    
+    Returns (success, report lines).
+    """
+    report = []
+    success = False
+    try:
+        with SESSION.get(endpoint, timeout=5, stream=True) as response:
+            if response.status_code == 200:
+                # Stream the body line by line instead of materializing it
+                if response.encoding is None:
+                    response.encoding = 'utf-8'
+                content_length = 0
+                metric_count = 0
+                samples = []
+                for line in response.iter_lines(decode_unicode=True):
+                    content_length += len(line) + 1
+                    # Check for Prometheus format
+                    if line and not line.startswith('#'):
+                        metric_count += 1
+                        if len(samples) < 3:
+                            samples.append(line)
+                
+                report.append(f"✓ SUCCESS: {endpoint}")
+                report.append(f"  Status: {response.status_code}")
+                report.append(f"  Content-Type: {response.headers.get('content-type', 'unknown')}")
+                report.append(f"  Content length: {content_length} characters")
+                report.append(f"  Metric lines: {metric_count}")
+                
+                # Show sample metrics
+                if samples:
+                    report.append("  Sample metrics:")
+                    for line in samples:
+                        report.append(f"    {line}")
+                
+                success = True
+                
+            else:
+                report.append(f"❌ FAILED: {endpoint} - Status {response.status_code}")
+            
+    except Exception as e:
+        report.append(failure_message(endpoint, e))
+    
+    return success, report
+
+
 def test_hades_connectivity():
     """Test connectivity to HADES metrics endpoint."""
-    print("\n" + "="*60)
-    print("Testing HADES Connectivity")
-    print("="*60)
+    log = ["\n" + "="*60, "Testing HADES Connectivity", "="*60]
     
     # Test different possible endpoints
     endpoints = [
@@ -67,93 +212,81 @@ def test_hades_connectivity():
         "http://127.0.0.1:8000/metrics"
     ]
     
-    for endpoint in endpoints:
-        try:
-            print(f"\nTesting {endpoint}...")
-            response = requests.get(endpoint, timeout=5)
+    # Probe all endpoints at once so a slow or unresolvable host doesn't add its
+    # full timeout to the total; the first successful endpoint wins
+    executor = ThreadPoolExecutor(max_workers=len(endpoints))
+    try:
+        futures = {executor.submit(probe_endpoint, endpoint): endpoint for endpoint in endpoints}
+        for future in as_completed(futures):
+            endpoint = futures[future]
+            alive, report = future.result()
+            log.extend(report)
             
-            if response.status_code == 200:
-                content = response.text
-                print(f"✓ SUCCESS: {endpoint}")
-                print(f"  Status: {response.status_code}")
-                print(f"  Content-Type: {response.headers.get('content-type', 'unknown')}")
-                print(f"  Content length: {len(content)} characters")
-                
-                # Check for Prometheus format
-                lines = content.strip().split('\n')
-                metric_lines = [line for line in lines if line and not line.startswith('#')]
-                print(f"  Metric lines: {len(metric_lines)}")
-                
-                # Show sample metrics
-                if metric_lines:
-                    print("  Sample metrics:")
-                    for line in metric_lines[:3]:
-                        print(f"    {line}")
-                
-                return True, endpoint
-                
-            else:
-                print(f"❌ FAILED: {endpoint} - Status {response.status_code}")
-                
-        except requests.exceptions.ConnectionError:
-            print(f"❌ FAILED: {endpoint} - Connection refused")
-        except requests.exceptions.Timeout:
-            print(f"❌ FAILED: {endpoint} - Timeout")
-        except Exception as e:
-            print(f"❌ FAILED: {endpoint} - Error: {e}")
+            # Only download the metrics body from endpoints that answered the probe
+            if alive:
+                success, report = fetch_endpoint_metrics(endpoint)
+                log.extend(report)
+                if success:
+                    return True, endpoint, log
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
     
-    return False, None
+    return False, None, log
 
 
 def test_prometheus_targets():
     """Test Prometheus targets endpoint."""
-    print("\n" + "="*60)
-    print("Testing Prometheus Targets")
-    print("="*60)
+    log = ["\n" + "="*60, "Testing Prometheus Targets", "="*60]
     
     try:
         # Test Prometheus API
         prometheus_url = "http://localhost:9090/api/v1/targets"
-        response = requests.get(prometheus_url, timeout=10)
+        # Only active targets are inspected, so skip the dropped-target list server-side
+        response = SESSION.get(
+            prometheus_url,
+            params={"state": "active"},
+            headers={"Accept-Encoding": "gzip"},
+            timeout=10
+        )
         
         if response.status_code == 200:
-            data = response.json()
+            data = _json_loads(response.content)
             targets = data.get('data', {}).get('activeTargets', [])
             
-            print(f"✓ Prometheus API accessible")
-            print(f"✓ Found {len(targets)} active targets")
+            log.append(f"✓ Prometheus API accessible")
+            log.append(f"✓ Found {len(targets)} active targets")
             
             # Look for HADES targets
-            hades_targets = [t for t in targets if 'hades' in t.get('job', '').lower()]
+            hades_targets = [t for t in targets if HADES_RE.search(t.get('job') or '')]
             
             if hades_targets:
-                print(f"✓ Found {len(hades_targets)} HADES target(s):")
+                log.append(f"✓ Found {len(hades_targets)} HADES target(s):")
                 for target in hades_targets:
                     job = target.get('job')
                     endpoint = target.get('scrapeUrl')
                     health = target.get('health')
                     last_error = target.get('lastError', 'None')
                     
-                    print(f"  - Job: {job}")
-                    print(f"    Endpoint: {endpoint}")
-                    print(f"    Health: {health}")
+                    log.append(f"  - Job: {job}")
+                    log.append(f"    Endpoint: {endpoint}")
+                    log.append(f"    Health: {health}")
                     if last_error != 'None':
-                        print(f"    Last Error: {last_error}")
+                        log.append(f"    Last Error: {last_error}")
             else:
-                print("❌ No HADES targets found in Prometheus")
-                print("Available targets:")
+                log.append("❌ No HADES targets found in Prometheus")
+                log.append("Available targets:")
                 for target in targets[:5]:  # Show first 5 targets
-                    print(f"  - {target.get('job')}: {target.get('scrapeUrl')}")
+                    log.append(f"  - {target.get('job')}: {target.get('scrapeUrl')}")
             
-            return True
+            return True, log
             
         else:
-            print(f"❌ Prometheus API not accessible - Status {response.status_code}")
-            return False
+            log.append(f"❌ Prometheus API not accessible - Status {response.status_code}")
+            return False, log
             
     except Exception as e:
-        print(f"❌ Error testing Prometheus: {e}")
-        return False
+        log.append(f"❌ Error testing Prometheus: {e}")
+        return False, log
 
 
 def main():
@@ -161,43 +294,60 @@ def main():
     print("HADES-Ladon Monitoring Integration Test")
     print("=" * 60)
     
-    results = []
-    
-    # Test 1: Prometheus configuration
-    config_ok = test_prometheus_config()
-    results.append(("Prometheus Config", config_ok))
-    
-    # Test 2: HADES connectivity
-    hades_ok, working_endpoint = test_hades_connectivity()
-    results.append(("HADES Connectivity", hades_ok))
-    
-    # Test 3: Prometheus targets (only if Prometheus is running)
-    prometheus_ok = test_prometheus_targets()
-    results.append(("Prometheus Targets", prometheus_ok))
-    
-    # Summary
-    print("\n" + "="*60)
-    print("Integration Test Summary")
-    print("="*60)
-    
-    for test_name, success in results:
-        status = "✅ PASS" if success else "❌ FAIL"
-        print(f"{test_name}: {status}")
-    
-    all_passed = all(result[1] for result in results)
-    
-    if all_passed:
-        print(f"\n🎉 All tests passed! Integration ready.")
-        if working_endpoint:
-            print(f"HADES metrics available at: {working_endpoint}")
-    else:
-        print(f"\n⚠️  Some tests failed. Check configuration and connectivity.")
-        print("\nNext steps:")
-        print("1. Start HADES API server: poetry run python -m src.api.server")
-        print("2. Start ladon monitoring: ./monitoring.sh start")
-        print("3. Check network connectivity between services")
-    
-    return 0 if all_passed else 1
+    # The tests share no state and mostly wait on I/O, so run them concurrently.
+    # Each test returns its output lines, which are written in order afterwards.
+    try:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            config_future = executor.submit(test_prometheus_config)
+            hades_future = executor.submit(test_hades_connectivity)
+            prometheus_future = executor.submit(test_prometheus_targets)
+            wait([config_future, hades_future, prometheus_future], return_when=ALL_COMPLETED)
+        
+        results = []
+        output = []
+        
+        # Test 1: Prometheus configuration
+        config_ok, log = config_future.result()
+        output.extend(log)
+        results.append(("Prometheus Config", config_ok))
+        
+        # Test 2: HADES connectivity
+        hades_ok, working_endpoint, log = hades_future.result()
+        output.extend(log)
+        results.append(("HADES Connectivity", hades_ok))
+        
+        # Test 3: Prometheus targets (only if Prometheus is running)
+        prometheus_ok, log = prometheus_future.result()
+        output.extend(log)
+        results.append(("Prometheus Targets", prometheus_ok))
+        
+        sys.stdout.write("\n".join(output) + "\n")
+        
+        # Summary
+        print("\n" + "="*60)
+        print("Integration Test Summary")
+        print("="*60)
+        
+        all_passed = True
+        for test_name, success in results:
+            all_passed &= success
+            status = "✅ PASS" if success else "❌ FAIL"
+            print(f"{test_name}: {status}")
+        
+        if all_passed:
+            print(f"\n🎉 All tests passed! Integration ready.")
+            if working_endpoint:
+                print(f"HADES metrics available at: {working_endpoint}")
+        else:
+            print(f"\n⚠️  Some tests failed. Check configuration and connectivity.")
+            print("\nNext steps:")
+            print("1. Start HADES API server: poetry run python -m src.api.server")
+            print("2. Start ladon monitoring: ./monitoring.sh start")
+            print("3. Check network connectivity between services")
+        
+        return 0 if all_passed else 1
+    finally:
+        SESSION.close()
 
 
 if __name__ == "__main__":